@@ -2,7 +2,7 @@ from enum import Enum
 from dataclasses import dataclass
 from typing import Optional, Dict, Callable
 import threading
-import queue
+from collections import deque, OrderedDict
 import time
 import json
 import os
@@ -12,7 +12,8 @@ import busio
 from pygame import mixer
 from adafruit_pn532.i2c import PN532_I2C
 import RPi.GPIO as GPIO
-from rx.subject import Subject
+from rx.subject import BehaviorSubject
+from rx.scheduler import EventLoopScheduler
 
 class PlaybackState(Enum):
    STOPPED = "stopped"
@@ -25,39 +26,118 @@ class AudioStatus:
    volume: int = 50
    current_file: Optional[str] = None
 
+# Sentinelle déposée dans la file pour arrêter le thread de commandes
+_SHUTDOWN = object()
+
+# Codes des commandes audio (index dans AudioPlayer._handlers)
+_OP_PLAY, _OP_STOP, _OP_PAUSE, _OP_RESUME, _OP_VOL = range(5)
+
+# Les petits fichiers (effets sonores) sont décodés une fois et gardés en mémoire.
+# Le cache est borné par la taille PCM décodée, pas par la taille du fichier.
+SOUND_MAX_SIZE = 64 * 1024
+SOUND_CACHE_BYTES = 16 * 1024 * 1024
+_PCM_BYTES_PER_SECOND = 44100 * 2 * 2  # 44,1 kHz, stéréo, 16 bits (cf. mixer.init)
+
 class AudioPlayer:
+   _STOPPED = PlaybackState.STOPPED
+   _PLAYING = PlaybackState.PLAYING
+   _PAUSED = PlaybackState.PAUSED
+   
    def __init__(self):
        mixer.init(frequency=44100, size=-16, channels=2)
+       self._music = mixer.music
+       self._channel: Optional[mixer.Channel] = None  # Défini si un Sound joue à la place de mixer.music
+       self._sounds: OrderedDict = OrderedDict()  # Cache LRU chemin -> (Sound, octets décodés)
+       self._sounds_bytes = 0
        self.status = AudioStatus()
-       self._command_queue = queue.Queue()
-       self._state_lock = threading.RLock()
+       self._cmds = deque()
+       self._wake = threading.Event()
+       self._state_lock = threading.Lock()
+       self.running = True
        
        self.on_start: Optional[Callable] = None
        self.on_stop: Optional[Callable] = None
        
-       threading.Thread(target=self._process_commands, daemon=True).start()
+       self._handlers = (self._play, self._stop, self._pause, self._resume, self._set_volume)
+       
+       self._worker = threading.Thread(target=self._process_commands, daemon=True)
+       self._worker.start()
    
    def _process_commands(self):
        while True:
-           try:
-               cmd, args = self._command_queue.get(timeout=0.5)
-               with self._state_lock:
-                   cmd(*args)
-           except queue.Empty:
+           self._wake.wait()
+           self._wake.clear()
+           
+           # Vide la file d'un coup pour traiter les commandes par lot
+           batch = []
+           while True:
+               try:
+                   batch.append(self._cmds.popleft())
+               except IndexError:
+                   break
+           if not batch:
                continue
+           
+           with self._state_lock:
+               for op, arg in self._coalesce(batch):
+                   if op is _SHUTDOWN:
+                       return
+                   self._handlers[op](arg)
    
+   def _submit(self, op, arg):
+       self._cmds.append((op, arg))
+       self._wake.set()
+   
+   @staticmethod
+   def _coalesce(batch: list) -> list:
+       """Ne garde que le dernier volume du lot et la dernière pause/reprise de chaque suite"""
+       last_vol = max((i for i, (op, _) in enumerate(batch) if op == _OP_VOL), default=-1)
+       commands = []
+       for i, (op, arg) in enumerate(batch):
+           if op == _OP_VOL and i != last_vol:
+               continue
+           if op in (_OP_PAUSE, _OP_RESUME) and commands and commands[-1][0] in (_OP_PAUSE, _OP_RESUME):
+               commands[-1] = (op, arg)
+               continue
+           commands.append((op, arg))
+       return commands
+   
+   def _load_sound(self, path: str) -> mixer.Sound:
+       cached = self._sounds.get(path)
+       if cached:
+           self._sounds.move_to_end(path)
+           return cached[0]
+           
+       sound = mixer.Sound(path)
+       size = int(sound.get_length() * _PCM_BYTES_PER_SECOND)
+       if size > SOUND_CACHE_BYTES:
+           return sound
+       
+       self._sounds[path] = (sound, size)
+       self._sounds_bytes += size
+       while self._sounds_bytes > SOUND_CACHE_BYTES:
+           _, (_, evicted) = self._sounds.popitem(last=False)
+           self._sounds_bytes -= evicted
+       return sound
+       
    def play(self, file_path: str):
-       self._command_queue.put((self._play, [file_path]))
+       self._submit(_OP_PLAY, file_path)
        
    def _play(self, file_path: str):
        try:
-           if self.status.state != PlaybackState.STOPPED:
-               mixer.music.stop()
+           if self.status.state != self._STOPPED:
+               self._halt()
                
-           mixer.music.load(file_path)
-           mixer.music.play()
+           if os.path.getsize(file_path) < SOUND_MAX_SIZE:
+               self._channel = self._load_sound(file_path).play()
+               # Sound.play() remet le volume du canal à 1.0
+               if self._channel:
+                   self._channel.set_volume(self.status.volume / 100)
+           else:
+               self._music.load(file_path)
+               self._music.play()
            
-           self.status.state = PlaybackState.PLAYING
+           self.status.state = self._PLAYING
            self.status.current_file = file_path
            
            if self.on_start:
@@ -67,42 +147,62 @@ class AudioPlayer:
            logging.error(f"Play error: {e}")
            
    def stop(self):
-       self._command_queue.put((self._stop, []))
+       self._submit(_OP_STOP, None)
        
-   def _stop(self):
-       if self.status.state != PlaybackState.STOPPED:
-           mixer.music.stop()
-           self.status.state = PlaybackState.STOPPED
+   def _halt(self):
+       if self._channel:
+           self._channel.stop()
+           self._channel = None
+       else:
+           self._music.stop()
+           
+   def _stop(self, _=None):
+       if self.status.state != self._STOPPED:
+           self._halt()
+           self.status.state = self._STOPPED
            self.status.current_file = None
            
            if self.on_stop:
                self.on_stop()
                
    def pause(self):
-       self._command_queue.put((self._pause, []))
+       self._submit(_OP_PAUSE, None)
        
-   def _pause(self):
-       if self.status.state == PlaybackState.PLAYING:
-           mixer.music.pause()
-           self.status.state = PlaybackState.PAUSED
+   def _pause(self, _=None):
+       if self.status.state == self._PLAYING:
+           if self._channel:
+               self._channel.pause()
+           else:
+               self._music.pause()
+           self.status.state = self._PAUSED
            
    def resume(self):
-       self._command_queue.put((self._resume, []))
+       self._submit(_OP_RESUME, None)
        
-   def _resume(self):
-       if self.status.state == PlaybackState.PAUSED:
-           mixer.music.unpause()
-           self.status.state = PlaybackState.PLAYING
+   def _resume(self, _=None):
+       if self.status.state == self._PAUSED:
+           if self._channel:
+               self._channel.unpause()
+           else:
+               self._music.unpause()
+           self.status.state = self._PLAYING
            
    def set_volume(self, volume: int):
-       self._command_queue.put((self._set_volume, [volume]))
+       self._submit(_OP_VOL, volume)
        
    def _set_volume(self, volume: int):
        self.status.volume = max(0, min(100, volume))
-       mixer.music.set_volume(self.status.volume / 100)
+       self._music.set_volume(self.status.volume / 100)
+       if self._channel:
+           self._channel.set_volume(self.status.volume / 100)
        
    def cleanup(self):
        self.stop()
+       self.running = False
+       self._submit(_SHUTDOWN, None)
+       self._worker.join(timeout=1)
+       self._sounds.clear()
+       self._sounds_bytes = 0
        mixer.quit()
 
 class MusicBox:
@@ -112,38 +212,52 @@ class MusicBox:
        # Configuration des GPIO
        self.volume_pins = {'up': 22, 'down': 27, 'play': 17}
        self.button_cooldown = 0.3
-       self.last_button_press = 0
        
        # Initialisation NFC
        self.i2c = busio.I2C(board.SCL, board.SDA)
        self.pn532 = PN532_I2C(self.i2c, debug=False)
        self.pn532.SAM_configuration()
        self.last_read = {'tag': None, 'time': 0}
+       self.present_timeout = 0.05  # Scan rapide pour détecter le retrait du tag
+       self.absent_timeout = 0.5
+       self._last_uid_bytes: bytes = b''
+       self._last_uid_str: Optional[str] = None
+       self._last_logged_state = None
        
        # Audio
        self.audio = AudioPlayer()
        
        # États et verrous
        self.running = True
-       self._tag_subject = Subject()
-       self._state_lock = threading.RLock()
+       self._tag_subject = BehaviorSubject(None)
+       self._rx_scheduler = EventLoopScheduler()
+       self._state_lock = threading.Lock()
+       
+       # Volume cible tenu localement pour la répétition automatique
+       self._volume = self.audio.status.volume
+       self._volume_timer: Optional[threading.Timer] = None
        
        # Configuration GPIO
        GPIO.setmode(GPIO.BCM)
        for pin in self.volume_pins.values():
            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
            
+       # Détection des fronts descendants avec anti-rebond matériel
+       bouncetime = int(self.button_cooldown * 1000)
+       GPIO.add_event_detect(self.volume_pins['up'], GPIO.FALLING, callback=self._on_vol_up, bouncetime=bouncetime)
+       GPIO.add_event_detect(self.volume_pins['down'], GPIO.FALLING, callback=self._on_vol_down, bouncetime=bouncetime)
+       GPIO.add_event_detect(self.volume_pins['play'], GPIO.FALLING, callback=self._on_play, bouncetime=bouncetime)
+           
        # Chargement config
        self.nfc_data = self._load_nfc_data()
+       self._tag_index = {item['idtagnfc']: item['path'] for item in self.nfc_data}
        
        # Démarrage threads
        self._start_threads()
        
    def _start_threads(self):
        self.nfc_thread = threading.Thread(target=self._nfc_loop, daemon=True)
-       self.button_thread = threading.Thread(target=self._button_loop, daemon=True) 
        self.nfc_thread.start()
-       self.button_thread.start()
        
    def _load_nfc_data(self) -> list:
        try:
@@ -156,75 +270,119 @@ class MusicBox:
    def _nfc_loop(self):
     while self.running:
         try:
-            current_time = time.time()
-            tag = self._read_tag()
+            present = self.last_read['tag'] is not None
+            tag = self._read_tag(self.present_timeout if present else self.absent_timeout)
             
             if tag:
-                print(f"[NFC] Tag detected: {tag}")
-                
                 # Premier scan ou nouveau tag
                 if tag != self.last_read['tag']:
-                    print("[NFC] New tag - Starting playback")
-                    self.last_read = {'tag': tag, 'time': current_time}
+                    self._log_nfc_state(f"New tag {tag} - Starting playback")
+                    self.last_read = {'tag': tag, 'time': time.monotonic()}
                     self._handle_tag(tag)
                     
                 # Tag toujours présent    
                 else:
-                    print("[NFC] Tag still present - Continuing playback")
-                time.sleep(1) # Vérification toutes les secondes si tag présent
+                    self._log_nfc_state("Tag still present - Continuing playback")
+                # Le PN532 répond dès que le tag est lu, on espace donc les scans
+                time.sleep(self.present_timeout)
                 
             else:
                 # Tag retiré
                 if self.last_read['tag']:
-                    print("[NFC] Tag removed - Stopping playback")
+                    self._log_nfc_state("Tag removed - Stopping playback")
                     self.audio.stop()
-                    self.last_read = {'tag': None, 'time': current_time}
+                    self._publish_tag(None)
+                    self.last_read = {'tag': None, 'time': time.monotonic()}
                 else:
-                    print("[NFC] No tag detected")
-                time.sleep(0.5) # Scan 2x par seconde si pas de tag
+                    self._log_nfc_state("No tag detected")
+                # Pas de pause : le timeout du PN532 sert d'attente
                
         except Exception as e:
             self.logger.error(f"NFC error: {e}")
             time.sleep(1)
             
-   def _read_tag(self) -> Optional[str]:
+   def _log_nfc_state(self, state: str):
+       # Ne journalise que les changements d'état pour éviter le spam en boucle
+       if state != self._last_logged_state and self.logger.isEnabledFor(logging.DEBUG):
+           self.logger.debug(f"[NFC] {state}")
+       self._last_logged_state = state
+       
+   def _read_tag(self, timeout: float = 0.5) -> Optional[str]:
        try:
-           uid = self.pn532.read_passive_target(timeout=0.5)
+           uid = self.pn532.read_passive_target(timeout=timeout)
            if uid:
-               return ':'.join([hex(i)[2:].upper().zfill(2) for i in uid])
+               # Réutilise la chaîne formatée tant que le même tag est lu
+               uid_bytes = bytes(uid)
+               if uid_bytes == self._last_uid_bytes:
+                   return self._last_uid_str
+               uid_str = uid_bytes.hex(':').upper()
+               self._last_uid_bytes, self._last_uid_str = uid_bytes, uid_str
+               return uid_str
        except Exception as e:
            self.logger.error(f"Tag read error: {e}")
        return None
        
    def _handle_tag(self, tag: str):
-        self._tag_subject.on_next(tag)
-        audio_file = next((item['path'] for item in self.nfc_data 
-                        if item['idtagnfc'] == tag), None) 
+        self._publish_tag(tag)
+        audio_file = self._tag_index.get(tag)
         
         if audio_file:
-            print(f"[Player] Playing file: {audio_file}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"[Player] Playing file: {audio_file}")
             self.audio.play(audio_file)
         else:
-            print(f"[NFC] No audio file for tag: {tag}")
+            self.logger.warning(f"[NFC] No audio file for tag: {tag}")
            
-   def _button_loop(self):
-    while self.running:
-        current_time = time.time()
-        if current_time - self.last_button_press >= self.button_cooldown:
-            if not GPIO.input(self.volume_pins['up']):
-                print(f"[Buttons] Volume up: {self.audio.status.volume + 10}")
-                self.audio.set_volume(self.audio.status.volume + 10)
-                self.last_button_press = current_time
-            elif not GPIO.input(self.volume_pins['down']):
-                print(f"[Buttons] Volume down: {self.audio.status.volume - 10}")
-                self.audio.set_volume(self.audio.status.volume - 10) 
-                self.last_button_press = current_time
-            elif not GPIO.input(self.volume_pins['play']):
-                state = "Pausing" if self.audio.status.state == PlaybackState.PLAYING else "Resuming"
-                print(f"[Buttons] {state} playback")
-                self._handle_play_button()
-                self.last_button_press = current_time
-        time.sleep(0.05)
+   def _publish_tag(self, tag: Optional[str]):
+       # Notifie les abonnés hors du thread NFC, sans répéter la valeur courante
+       def emit(_scheduler, _state):
+           if tag != self._tag_subject.value:
+               self._tag_subject.on_next(tag)
+       self._rx_scheduler.schedule(emit)
+           
+   def _on_vol_up(self, channel: int):
+       self._on_volume_button(channel, 10)
+       
+   def _on_vol_down(self, channel: int):
+       self._on_volume_button(channel, -10)
+       
+   def _on_volume_button(self, pin: int, delta: int):
+       with self._state_lock:
+           if self._volume_timer:
+               self._volume_timer.cancel()
+           self._apply_volume_delta(delta)
+           self._arm_volume_repeat(pin, delta)
+           
+   def _volume_repeat(self, pin: int, delta: int):
+       # Répète le pas de volume tant que le bouton reste enfoncé
+       with self._state_lock:
+           if threading.current_thread() is not self._volume_timer:
+               return
+           self._volume_timer = None
+           if not self.running or GPIO.input(pin):
+               return
+           self._apply_volume_delta(delta)
+           self._arm_volume_repeat(pin, delta)
+           
+   def _arm_volume_repeat(self, pin: int, delta: int):
+       self._volume_timer = threading.Timer(self.button_cooldown, self._volume_repeat, args=(pin, delta))
+       self._volume_timer.daemon = True
+       self._volume_timer.start()
+       
+   def _apply_volume_delta(self, delta: int):
+       volume = max(0, min(100, self._volume + delta))
+       if volume == self._volume:
+           return
+       self._volume = volume
+       if self.logger.isEnabledFor(logging.DEBUG):
+           self.logger.debug(f"[Buttons] Volume: {volume}")
+       self.audio.set_volume(volume)
+       
+   def _on_play(self, channel: int):
+       if self.logger.isEnabledFor(logging.DEBUG):
+           state = "Pausing" if self.audio.status.state == PlaybackState.PLAYING else "Resuming"
+           self.logger.debug(f"[Buttons] {state} playback")
+       self._handle_play_button()
            
    def _handle_play_button(self):
        if self.audio.status.state == PlaybackState.PLAYING:
@@ -233,13 +391,18 @@ class MusicBox:
            self.audio.resume()
            
    @property
-   def tag_subject(self) -> Subject:
+   def tag_subject(self) -> BehaviorSubject:
        return self._tag_subject
            
    def cleanup(self):
        self.logger.info("Cleaning up...")
        self.running = False
+       with self._state_lock:
+           if self._volume_timer:
+               self._volume_timer.cancel()
+               self._volume_timer = None
        self.audio.cleanup()
+       self._rx_scheduler.dispose()
        GPIO.cleanup()
        self.logger.info("Cleanup complete")
 
@@ -2,10 +2,24 @@ import os
 import json
 import time
 import logging
+from itertools import islice
 import board
 import busio
 from adafruit_pn532.i2c import PN532_I2C
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional
+
+try:
+    import orjson
+
+    def _dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def _dumps(data) -> bytes:
+        return json.dumps(data).encode()
+
+MUSIC_EXTENSIONS = {'.mp3', '.wav', '.ogg', '.flac'}
+SAVE_EVERY = 8  # Nombre d'associations entre deux sauvegardes
+PREVIEW_COUNT = 20  # Nombre de fichiers non associés affichés avant le scan
 
 class NFCMusicAssociator:
     def __init__(self, music_dir: str, nfc_data_file: str):
@@ -42,27 +56,44 @@ class NFCMusicAssociator:
     def save_nfc_data(self, data: List[Dict]):
         """Sauvegarde les données NFC"""
         try:
-            with open(self.nfc_data_file, 'w') as f:
-                json.dump(data, f, indent=2)
+            # Écriture dans un fichier temporaire puis remplacement atomique
+            tmp = self.nfc_data_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(_dumps(data))
+            os.replace(tmp, self.nfc_data_file)
         except Exception as e:
             self.logger.error(f"Error saving NFC data: {e}")
 
     def get_music_files(self) -> List[str]:
         """Récupère la liste des fichiers musicaux"""
-        music_files = []
-        for root, _, files in os.walk(self.music_dir):
-            for file in files:
-                if file.lower().endswith(('.mp3', '.wav', '.ogg', '.flac')):
-                    full_path = os.path.abspath(os.path.join(root, file))
-                    music_files.append(full_path)
-        return music_files
+        if not os.path.isdir(self.music_dir):
+            return []
+        return list(self._walk(self.music_dir))
+
+    def _walk(self, directory: str) -> Iterator[str]:
+        """Parcourt récursivement le dossier (music_dir est déjà absolu)"""
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            # Comme os.walk, ignore les dossiers illisibles ou disparus
+            self.logger.debug(f"Skipping directory {directory}: {e}")
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._walk(entry.path)
+                elif entry.is_file():
+                    name = entry.name
+                    dot = name.rfind('.')
+                    if dot >= 0 and name[dot:].lower() in MUSIC_EXTENSIONS:
+                        yield entry.path
 
     def read_nfc_tag(self, timeout: float = 0.5) -> Optional[str]:
         """Lit un tag NFC et retourne son ID"""
         try:
             uid = self.pn532.read_passive_target(timeout=timeout)
             if uid is not None:
-                return ':'.join([hex(i)[2:].upper().zfill(2) for i in uid])
+                return bytes(uid).hex(':').upper()
             return None
         except Exception as e:
             self.logger.error(f"Error reading NFC tag: {e}")
@@ -75,25 +106,31 @@ class NFCMusicAssociator:
         
         print(f"\nTrouvé {len(music_files)} fichiers musicaux au total.")
         
-        # Récupère les chemins absolus des fichiers déjà associés
-        associated_files = {os.path.abspath(item['path']) for item in nfc_data}
+        # Les chemins enregistrés sont déjà absolus (issus de get_music_files)
+        associated_files = {item['path'] for item in nfc_data}
         associated_tags = {item['idtagnfc'] for item in nfc_data}
         
         print(f"Dont {len(associated_files)} déjà associés.")
         
         # Trouve les fichiers non associés
-        unassociated_files = [f for f in music_files if f not in associated_files]
+        def unassociated():
+            return (f for f in music_files if f not in associated_files)
+        
+        unassociated_count = sum(1 for _ in unassociated())
         
-        if not unassociated_files:
+        if not unassociated_count:
             print("\nTous les fichiers sont déjà associés !")
             return
             
-        print(f"\nTrouvé {len(unassociated_files)} fichiers non associés :")
-        for f in unassociated_files:
+        print(f"\nTrouvé {unassociated_count} fichiers non associés :")
+        for f in islice(unassociated(), PREVIEW_COUNT):
             print(f"- {os.path.basename(f)}")
+        if unassociated_count > PREVIEW_COUNT:
+            print(f"... et {unassociated_count - PREVIEW_COUNT} autres")
         
+        pending = 0
         try:
-            for file_path in unassociated_files:
+            for file_path in unassociated():
                 file_name = os.path.basename(file_path)
                 print(f"\n{'='*50}")
                 print(f"Fichier en attente d'association : {file_name}")
@@ -117,8 +154,11 @@ class NFCMusicAssociator:
                         })
                         associated_tags.add(tag_id)
                         
-                        # Sauvegarde immédiate
-                        self.save_nfc_data(nfc_data)
+                        # Sauvegarde par lot, le finally sauvegarde le reste
+                        pending += 1
+                        if pending >= SAVE_EVERY:
+                            self.save_nfc_data(nfc_data)
+                            pending = 0
                         
                         print(f"Association réussie ! Tag: {tag_id}")
                         break